@@ -1,21 +1,62 @@
 from apify import Actor
-from apify_client import ApifyClient
+from apify_client import ApifyClientAsync
+import aiohttp
 import asyncio
+import contextlib
 import os
-import time
-import requests
+import sys
+import types
+import urllib.parse
+from dataclasses import dataclass
 import pycountry
 import re
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # stdlib fallback for environments without orjson wheels
+    from json import loads as json_loads
+
+
+# =====================================================
+# ACTOR INPUT (NORMALIZED ONCE)
+# =====================================================
+@dataclass(slots=True, frozen=True)
+class Inputs:
+    sector: str
+    country: str
+    state: str
+    city: str
+    postcode: str
+    keyword: str
+    max_results: int
+    sector_key: str
+
+
+def parse_inputs(data):
+    fields = {
+        k: (data.get(k) or "").strip()
+        for k in ("sector", "country", "state", "city", "postcode", "keyword")
+    }
+    return Inputs(
+        **fields,
+        max_results=int(data.get("maxResults", 25)),
+        sector_key=sys.intern(fields["sector"].lower())
+    )
+
 
 # =====================================================
 # COUNTRY → ISO-2 CODE
 # =====================================================
+_COUNTRY_TO_ISO2 = {}
+for _c in pycountry.countries:
+    for _attr in ("name", "common_name", "official_name", "alpha_2", "alpha_3"):
+        _value = getattr(_c, _attr, None)
+        if _value:
+            _COUNTRY_TO_ISO2[_value.lower()] = _c.alpha_2.lower()
+
+
 def get_country_code(country_name: str):
-    try:
-        return pycountry.countries.lookup(country_name).alpha_2.lower()
-    except Exception:
-        return None
+    return _COUNTRY_TO_ISO2.get((country_name or "").strip().lower())
 
 
 # =====================================================
@@ -36,27 +77,30 @@ def build_region(country, state=None, city=None, postcode=None):
 # =====================================================
 # SECTOR → GOOGLE MAPS SEARCH TERMS
 # =====================================================
-def sector_keywords(sector, keyword=None):
+# Keyed by the normalized (lower-cased) sector, see Inputs.sector_key
+SECTOR_KEYWORDS = types.MappingProxyType({
+    "food & beverage": ("restaurant", "cafe", "food supplier"),
+    "healthcare": ("hospital", "clinic", "medical centre"),
+    "manufacturing": ("manufacturer", "factory", "industrial supplier"),
+    "it & technology": ("software company", "IT services")
+})
+
+
+def sector_keywords(sector_key, keyword=None):
     if keyword:
         return [keyword]
 
-    sector_map = {
-        "Food & Beverage": ["restaurant", "cafe", "food supplier"],
-        "Healthcare": ["hospital", "clinic", "medical centre"],
-        "Manufacturing": ["manufacturer", "factory", "industrial supplier"],
-        "IT & Technology": ["software company", "IT services"]
-    }
-
-    return sector_map.get(sector, [sector.lower()])
+    return list(SECTOR_KEYWORDS.get(sector_key, (sector_key,)))
 
 
 # =====================================================
 # POSTCODE FILTER (OPTIONAL)
 # =====================================================
-def postcode_valid(item, postcode=None):
+def postcode_pattern(postcode=None):
+    # Case-insensitive search runs in C without lower-casing every address
     if not postcode:
-        return True
-    return postcode.lower() in (item.get("address") or "").lower()
+        return None
+    return re.compile(re.escape(postcode), re.I)
 
 
 # =====================================================
@@ -65,9 +109,60 @@ def postcode_valid(item, postcode=None):
 EMAIL_REGEX = re.compile(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")
 WHATSAPP_REGEX = re.compile(r"(?:\+?\d[\d\s\-]{8,}\d)")
 CONTACT_PAGE_REGEX = re.compile(r'href="([^"]*(contact|about)[^"]*)"', re.I)
+ENRICH_SCAN_CHARS = 20000
+
+
+def first_n_unique(regex, text, n, group=0):
+    # Stops after n distinct matches; contact details sit near the top of a
+    # page, so only its first ENRICH_SCAN_CHARS are scanned
+    found = {}
+    for match in regex.finditer(text, 0, ENRICH_SCAN_CHARS):
+        found[match.group(group)] = None
+        if len(found) >= n:
+            break
+    return list(found)
+
 
+FIRECRAWL_SCRAPE_URL = "https://api.firecrawl.dev/v1/scrape"
+FIRECRAWL_RETRIES = 2
+FIRECRAWL_BACKOFF_SECS = 0.3
+FIRECRAWL_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+FIRECRAWL_RETRY_AFTER_MAX_SECS = 10
 
-def firecrawl_enrich(url):
+_http_session = None
+
+
+async def get_http_session():
+    # One pooled session per process keeps TCP/TLS to Firecrawl alive
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=50, keepalive_timeout=30, ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def retry_after_secs(value):
+    # Retry-After in delta-seconds form, capped so one 429 cannot stall the
+    # run; HTTP-date or garbage values fall back to the normal backoff
+    try:
+        secs = float(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(secs, 0.0), FIRECRAWL_RETRY_AFTER_MAX_SECS)
+
+
+async def firecrawl_enrich(url):
     api_key = os.getenv("FIRECRAWL_API_KEY")
     if not api_key or not url:
         return {"status": "skipped"}
@@ -76,48 +171,60 @@ def firecrawl_enrich(url):
     if url.startswith("http://"):
         url = url.replace("http://", "https://", 1)
 
-    Actor.log.info(f"🔥 Firecrawl triggered for {url}")
-
     try:
-        resp = None
-
-        for _ in range(2):  # retry once
-            resp = requests.post(
-                "https://api.firecrawl.dev/v1/scrape",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "url": url,
-                    "formats": ["markdown"],
-                    "limit": 3
-                },
-                timeout=20
-            )
-            if resp.status_code == 200:
-                break
-
-        if not resp:
-            return {"status": "blocked"}
-
-        if resp.status_code != 200:
-            Actor.log.warning(
-                f"Firecrawl failed for {url} status={resp.status_code}"
-            )
-            return {"status": f"failed_{resp.status_code}"}
-
-        text = resp.json().get("data", {}).get("markdown", "") or ""
-
-        emails = list(set(EMAIL_REGEX.findall(text)))
-        whatsapp = list(set(WHATSAPP_REGEX.findall(text)))
-        contacts = [c[0] for c in CONTACT_PAGE_REGEX.findall(text)]
+        session = await get_http_session()
+        status = None
+        payload = None
+        retry_after = None
+
+        for attempt in range(FIRECRAWL_RETRIES + 1):
+            if attempt:
+                # Server's Retry-After on 429, else exponential backoff:
+                # 0.3 s, 0.6 s, ...
+                if retry_after is None:
+                    retry_after = FIRECRAWL_BACKOFF_SECS * 2 ** (attempt - 1)
+                await asyncio.sleep(retry_after)
+                retry_after = None
+
+            try:
+                async with session.post(
+                    FIRECRAWL_SCRAPE_URL,
+                    headers={
+                        "Authorization": f"Bearer {api_key}",
+                        "Content-Type": "application/json"
+                    },
+                    json={
+                        "url": url,
+                        "formats": ["markdown"],
+                        "limit": 3
+                    },
+                    timeout=aiohttp.ClientTimeout(total=20)
+                ) as resp:
+                    status = resp.status
+                    if status == 200:
+                        payload = json_loads(await resp.read())
+                        break
+                    if status not in FIRECRAWL_RETRY_STATUSES:
+                        break
+                    if status == 429:
+                        retry_after = retry_after_secs(resp.headers.get("Retry-After"))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # Resets and timeouts are as transient as a 503; only the
+                # last attempt's error falls through to "blocked"
+                if attempt == FIRECRAWL_RETRIES:
+                    raise
+
+        if status != 200:
+            Actor.log.warning(f"Firecrawl failed for {url} status={status}")
+            return {"status": f"failed_{status}"}
+
+        text = payload.get("data", {}).get("markdown", "") or ""
 
         return {
             "status": "attempted",
-            "emails": emails[:5],
-            "whatsappNumbers": whatsapp[:3],
-            "contactPages": contacts[:3],
+            "emails": first_n_unique(EMAIL_REGEX, text, 5),
+            "whatsappNumbers": first_n_unique(WHATSAPP_REGEX, text, 3),
+            "contactPages": first_n_unique(CONTACT_PAGE_REGEX, text, 3, group=1),
             "summary": text[:500]
         }
 
@@ -127,119 +234,338 @@ def firecrawl_enrich(url):
 
 
 # =====================================================
-# MAIN ACTOR
+# GOOGLE MAPS SEARCH (ONE QUERY)
 # =====================================================
-async def main():
-    async with Actor:
-        start_time = time.time()
-        data = await Actor.get_input() or {}
-
-        sector = data.get("sector", "")
-        country = data.get("country", "")
-        state = data.get("state", "")
-        city = data.get("city", "")
-        postcode = data.get("postcode", "")
-        keyword = data.get("keyword", "")
-        max_results = int(data.get("maxResults", 25))
-
-        Actor.log.info(f"Sector: {sector}")
-        Actor.log.info(f"Location: {country}, {state}, {city}, {postcode}")
-
-        region = build_region(country, state, city, postcode)
-        keywords = sector_keywords(sector, keyword)
-
-        Actor.log.info(f"Region anchor: {region}")
-        Actor.log.info(f"Search keywords: {keywords}")
-
-        client = ApifyClient(os.environ["APIFY_TOKEN"])
-
-        seen = set()
-        collected = []
-
-        # -------------------------------------------------
-        # GOOGLE MAPS SEARCH
-        # -------------------------------------------------
-        for term in keywords:
-            search_query = f"{term} near {region}"
-            Actor.log.info(f"Searching: {search_query}")
-
-            run_input = {
-                "searchStringsArray": [search_query],
-                "language": "en",
-                "includeWebResults": False,
-                "maxReviews": 0,
-                "maxImages": 0,
-                "maxConcurrency": 1,
-                "maxCrawledPlacesPerSearch": min(max_results * 2, 40)
-            }
-
-            cc = get_country_code(country)
-            if cc:
-                run_input["countryCode"] = cc
-
-            run = client.actor("compass/crawler-google-places").start(
-                run_input=run_input
-            )
+MAX_CONCURRENT_RUNS = 3
+CRAWL_TIMEOUT_SECS = 60
+POLL_WAIT_MIN_SECS = 1
+POLL_WAIT_MAX_SECS = 5
+DATASET_PAGE_SIZE = 100
+TERMINAL_RUN_STATUSES = frozenset({"SUCCEEDED", "FAILED", "TIMED-OUT", "ABORTED"})
 
-            dataset_id = run["defaultDatasetId"]
-            run_id = run["id"]
 
-            while True:
-                items = list(client.dataset(dataset_id).iterate_items())
+async def wait_for_run(run_client, stop_event, wait_secs):
+    # Long-poll the run status; wakes early on finish or a global stop
+    finish_task = asyncio.create_task(run_client.wait_for_finish(wait_secs=wait_secs))
+    stop_task = asyncio.create_task(stop_event.wait())
 
-                for item in items:
-                    if not postcode_valid(item, postcode):
+    try:
+        done, _ = await asyncio.wait(
+            {finish_task, stop_task}, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        # Also runs when the crawl deadline cancels us mid-wait
+        finish_task.cancel()
+        stop_task.cancel()
+
+    if finish_task in done:
+        run = finish_task.result()
+        return bool(run) and run.get("status") in TERMINAL_RUN_STATUSES
+    return False
+
+
+async def run_query(client, term, region, country_code, inputs,
+                    seen, collected, stop_event, semaphore, active_run_ids):
+    async with semaphore:
+        # Size this run by what is still missing, not by the full budget
+        remaining = inputs.max_results - len(collected)
+        if stop_event.is_set() or remaining <= 0:
+            return
+
+        search_query = f"{term} near {region}"
+        Actor.log.info(f"Searching: {search_query}")
+
+        run_input = {
+            "searchStringsArray": [search_query],
+            "language": "en",
+            "includeWebResults": False,
+            "maxReviews": 0,
+            "maxImages": 0,
+            "maxConcurrency": 1,
+            "maxCrawledPlacesPerSearch": min(remaining * 2, 40)
+        }
+
+        if country_code:
+            run_input["countryCode"] = country_code
+
+        run = await client.actor("compass/crawler-google-places").start(
+            run_input=run_input
+        )
+
+        active_run_ids.add(run["id"])
+        dataset_client = client.dataset(run["defaultDatasetId"])
+        run_client = client.run(run["id"])
+        offset = 0
+        finished = False
+        wait_secs = POLL_WAIT_MIN_SECS
+        added = filtered = 0
+        postcode_re = postcode_pattern(inputs.postcode)
+
+        while not stop_event.is_set():
+            polled_from = offset
+
+            # Only fetch items pushed since the previous poll, page by page
+            while not stop_event.is_set():
+                page = await dataset_client.list_items(
+                    offset=offset, limit=DATASET_PAGE_SIZE
+                )
+                offset += len(page.items)
+
+                for item in page.items:
+                    title, address = item.get("title"), item.get("address")
+                    if postcode_re and not postcode_re.search(address or ""):
+                        filtered += 1
                         continue
 
-                    key = f"{item.get('title')}_{item.get('address')}"
+                    # No await between the check and the append, so the shared
+                    # seen/collected state needs no lock across queries.
+                    key = (title, address)
                     if key not in seen:
                         seen.add(key)
                         collected.append(item)
+                        added += 1
 
-                if len(collected) >= max_results or time.time() - start_time > 60:
-                    client.run(run_id).abort()
+                    if len(collected) >= inputs.max_results:
+                        stop_event.set()
+                        break
+
+                if len(page.items) < DATASET_PAGE_SIZE:
                     break
 
-                await asyncio.sleep(2)
+            if finished or stop_event.is_set():
+                break
+
+            # Back off while the crawler is quiet, snap back once it yields.
+            # The first wait is always the minimum; waitForFinish takes whole
+            # seconds, hence the integer steps.
+            if offset > polled_from:
+                wait_secs = POLL_WAIT_MIN_SECS
+
+            # One more dataset read after the run finishes drains its tail
+            finished = await wait_for_run(run_client, stop_event, wait_secs)
+            wait_secs = min(wait_secs * 2, POLL_WAIT_MAX_SECS)
+
+        Actor.log.info(
+            f"Query '{search_query}' yielded {added} valid / {filtered} filtered"
+        )
+
+        if not finished:
+            await run_client.abort()
+        active_run_ids.discard(run["id"])
+
 
-            if len(collected) >= max_results:
+# =====================================================
+# LEAD NORMALIZATION (STREAMED)
+# =====================================================
+PUSH_BATCH_SIZE = 10
+ENRICH_LIMIT = 10
+FIRECRAWL_CONCURRENCY = 5
+B2B_SECTORS = frozenset({"manufacturing", "it & technology"})
+SKIPPED_ENRICHMENT = {"status": "skipped"}
+
+
+def website_key(url):
+    # Multi-location businesses share one site; scrape each site only once.
+    # Keyed on host plus path so distinct sites on one host (e.g. shared
+    # hosting or link pages) still get scraped separately.
+    if not url:
+        return None
+    try:
+        parts = urllib.parse.urlsplit(url if "//" in url else f"//{url}")
+    except ValueError:
+        return None
+    host = parts.netloc.lower().removeprefix("www.")
+    return host + parts.path.rstrip("/") if host else None
+
+
+def websites_to_enrich(items, inputs):
+    # Maps site key -> first website seen for it; only new sites use up the limit
+    # Without an API key every scrape would be skipped, so schedule none
+    if inputs.sector_key not in B2B_SECTORS or not os.getenv("FIRECRAWL_API_KEY"):
+        return {}
+
+    websites = {}
+    for item in items:
+        website = item.get("website")
+        key = website_key(website)
+        if key and key not in websites:
+            websites[key] = website
+            if len(websites) >= ENRICH_LIMIT:
                 break
+    return websites
+
+
+def enrich_websites(websites):
+    # Schedules every scrape right away and returns the tasks; each resolves
+    # to (key, enrichment). All scrapes share the pooled session and the
+    # semaphore keeps in-flight requests inside Firecrawl's rate limit.
+    semaphore = asyncio.Semaphore(FIRECRAWL_CONCURRENCY)
+
+    async def enrich_one(key, website):
+        try:
+            async with semaphore:
+                return key, await firecrawl_enrich(website)
+        except Exception as e:
+            Actor.log.warning(f"Firecrawl enrichment crashed for {website}: {e}")
+            return key, {"status": "blocked"}
+
+    return [
+        asyncio.create_task(enrich_one(key, website))
+        for key, website in websites.items()
+    ]
+
+
+def normalize_lead(item, inputs, enrichment):
+    return {
+        "name": item.get("title"),
+        "phone": item.get("phone"),
+        "website": item.get("website"),
+        "address": item.get("address"),
+        "rating": item.get("totalScore"),
+        "reviewCount": item.get("reviewsCount"),
+        "category": item.get("categoryName"),
+        "googleMapsUrl": item.get("url"),
+        "searchQuery": inputs.keyword or inputs.sector,
+
+        # 🔥 Enrichment (final, clean)
+        "firecrawlStatus": enrichment.get("status"),
+        "emails": enrichment.get("emails", []),
+        "whatsappNumbers": enrichment.get("whatsappNumbers", []),
+        "contactPages": enrichment.get("contactPages", []),
+        "websiteSummary": enrichment.get("summary", "")
+    }
+
+
+async def stream_leads(items, inputs):
+    # Leads without enrichment come out immediately, enriched ones as soon
+    # as their own scrape returns rather than after the slowest one
+    websites = websites_to_enrich(items, inputs)
+    if not websites:
+        for item in items:
+            yield normalize_lead(item, inputs, SKIPPED_ENRICHMENT)
+        return
+
+    Actor.log.info(f"🔥 Firecrawl triggered for {len(websites)} websites")
+    tasks = enrich_websites(websites)
+
+    try:
+        awaiting = {key: [] for key in websites}
+        for item in items:
+            key = website_key(item.get("website"))
+            if key in awaiting:
+                awaiting[key].append(item)
+            else:
+                yield normalize_lead(item, inputs, SKIPPED_ENRICHMENT)
+
+        for completion in asyncio.as_completed(tasks):
+            key, enrichment = await completion
+            for item in awaiting[key]:
+                yield normalize_lead(item, inputs, enrichment)
+    finally:
+        # Consumer stopped early (e.g. push_data raised): drop open scrapes
+        for task in tasks:
+            task.cancel()
+
+
+async def push_leads(batch):
+    # One summary log record per pushed batch, never one per lead
+    names = [lead["name"] for lead in batch]
+    Actor.log.info(f"Found {len(batch)} leads: {names}")
+    await Actor.push_data(batch)
+
+
+# =====================================================
+# MAIN ACTOR
+# =====================================================
+async def main():
+    async with Actor:
+        try:
+            inputs = parse_inputs(await Actor.get_input() or {})
+
+            region = build_region(
+                inputs.country, inputs.state, inputs.city, inputs.postcode
+            )
+            keywords = sector_keywords(inputs.sector_key, inputs.keyword)
+            country_code = get_country_code(inputs.country)
+
+            Actor.log.info(
+                f"Sector: {inputs.sector}\n"
+                f"Location: {inputs.country}, {inputs.state}, "
+                f"{inputs.city}, {inputs.postcode}\n"
+                f"Max results: {inputs.max_results}\n"
+                f"Region anchor: {region}\n"
+                f"Search keywords: {keywords}"
+            )
 
-        # -------------------------------------------------
-        # FINAL OUTPUT + FIRECRAWL
-        # -------------------------------------------------
-        output = []
-        enrich_limit = 10
-        B2B_SECTORS = ["Manufacturing", "IT & Technology"]
-
-        for item in collected[:max_results]:
-            website = item.get("website")
-            enrichment = {"status": "skipped"}
-
-            if sector in B2B_SECTORS and website and len(output) < enrich_limit:
-                enrichment = firecrawl_enrich(website)
-
-            output.append({
-                "name": item.get("title"),
-                "phone": item.get("phone"),
-                "website": website,
-                "address": item.get("address"),
-                "rating": item.get("totalScore"),
-                "reviewCount": item.get("reviewsCount"),
-                "category": item.get("categoryName"),
-                "googleMapsUrl": item.get("url"),
-                "searchQuery": keyword or sector,
-
-                # 🔥 Enrichment (final, clean)
-                "firecrawlStatus": enrichment.get("status"),
-                "emails": enrichment.get("emails", []),
-                "whatsappNumbers": enrichment.get("whatsappNumbers", []),
-                "contactPages": enrichment.get("contactPages", []),
-                "websiteSummary": enrichment.get("summary", "")
-            })
-
-        await Actor.push_data(output)
-        Actor.log.info(f"Finished successfully. Leads saved: {len(output)}")
+            client = ApifyClientAsync(os.environ["APIFY_TOKEN"])
+
+            seen = set()
+            collected = []
+
+            # -------------------------------------------------
+            # GOOGLE MAPS SEARCH (CONCURRENT)
+            # -------------------------------------------------
+            stop_event = asyncio.Event()
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+            active_run_ids = set()
+
+            tasks = [
+                asyncio.create_task(run_query(
+                    client, term, region, country_code, inputs,
+                    seen, collected, stop_event, semaphore, active_run_ids
+                ))
+                for term in keywords
+            ]
+
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*tasks, return_exceptions=True),
+                    timeout=CRAWL_TIMEOUT_SECS
+                )
+            except asyncio.TimeoutError:
+                Actor.log.info(
+                    f"Crawl deadline of {CRAWL_TIMEOUT_SECS}s reached, "
+                    f"keeping {len(collected)} leads"
+                )
+
+            # Tasks keep their own outcome, so failures from before the
+            # deadline are still reported after a timeout
+            for term, task in zip(keywords, tasks):
+                if task.done() and not task.cancelled() and task.exception():
+                    Actor.log.warning(f"Search failed for {term}: {task.exception()}")
+
+            # Runs left behind by a failed or timed-out query must not keep
+            # burning credits
+            if active_run_ids:
+                await asyncio.gather(
+                    *(client.run(run_id).abort() for run_id in active_run_ids),
+                    return_exceptions=True
+                )
+
+            # -------------------------------------------------
+            # FINAL OUTPUT + FIRECRAWL
+            # -------------------------------------------------
+            saved = 0
+            batch = []
+
+            # Concurrent pollers can overshoot the budget by a few items
+            del collected[inputs.max_results:]
+
+            async with contextlib.aclosing(stream_leads(collected, inputs)) as leads:
+                async for lead in leads:
+                    batch.append(lead)
+                    if len(batch) >= PUSH_BATCH_SIZE:
+                        await push_leads(batch)
+                        saved += len(batch)
+                        batch = []
+
+            if batch:
+                await push_leads(batch)
+                saved += len(batch)
+
+            Actor.log.info(f"Finished successfully. Leads saved: {saved}")
+        finally:
+            await close_http_session()
 
 
 if __name__ == "__main__":